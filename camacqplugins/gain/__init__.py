@@ -1,28 +1,23 @@
 """Handle default gain feedback plugin."""
 
+import asyncio
 import logging
 import os
 from collections import defaultdict, namedtuple
 from functools import partial
-from itertools import groupby
 from pathlib import Path
 
-import matplotlib
+import numpy as np
 import pandas as pd
 import voluptuous as vol
 from scipy.optimize import curve_fit
 
 from camacq.event import Event
 from camacq.helper import BASE_ACTION_SCHEMA
-from camacq.image import make_proj
-
-matplotlib.use("AGG")  # use noninteractive default backend
-# pylint: disable=wrong-import-order, wrong-import-position, ungrouped-imports
-import matplotlib.pyplot as plt  # noqa: E402
+from camacq.image import ImageData
 
 _LOGGER = logging.getLogger(__name__)
 BOX = "box"
-COUNT = "count"
 VALID = "valid"
 CHANNEL_ID = "C{:02d}"
 CONF_CHANNEL = "channel"
@@ -32,7 +27,10 @@ CONF_INIT_GAIN = "init_gain"
 CONF_SAVE_DIR = "save_dir"
 COUNT_CLOSE_TO_ZERO = 2
 GAIN_CALC_EVENT = "gain_calc_event"
+PLOTS = "plots"
 SAVED_GAINS = "saved_gains"
+# Images with these pixel side lengths are excluded from projections.
+SKIP_IMAGE_SIDES = frozenset({0, 16, 256})
 WELL = "well"
 WELL_NAME = "U{:02d}--V{:02d}"
 
@@ -60,12 +58,15 @@ CONFIG_SCHEMA = vol.Schema(
 )
 
 GAIN = "gain"
-Data = namedtuple("Data", [BOX, GAIN, VALID])  # pylint: disable=invalid-name
 Channel = namedtuple("Channel", ["name", GAIN])  # pylint: disable=invalid-name
 
 
 async def setup_module(center, config):
     """Set up gain calculation plugin."""
+    save_dir = config[CONF_GAIN].get(CONF_SAVE_DIR)
+    if save_dir:
+        # Create the plot dir once here instead of per gain calculation.
+        await center.add_executor_job(ensure_plot_dir, os.path.join(save_dir, PLOTS))
 
     async def handle_calc_gain(**kwargs):
         """Handle call to calc_gain action."""
@@ -81,10 +82,11 @@ async def setup_module(center, config):
                 return
             images = {path: image.channel_id for path, image in well.images.items()}
         else:
+            sample_images = center.samples.leica.images
             images = {
-                path: image.channel_id
-                for path, image in center.samples.leica.images.items()
-                if path in paths
+                path: sample_images[path].channel_id
+                for path in paths
+                if path in sample_images
             }
         projs = await center.add_executor_job(make_proj, images)
         await calc_gain(center, config, plate_name, well_x, well_y, projs)
@@ -102,13 +104,19 @@ async def calc_gain(
     well_y,
     projs,
 ):
-    """Calculate gain values for the well."""
+    """Calculate gain values for the well.
+
+    The plot dir in the save dir is created when the plugin is set up.
+    """
     # pylint: disable=too-many-arguments, too-many-locals
     gain_conf = config[CONF_GAIN]
-    save_dir = gain_conf.get(CONF_SAVE_DIR) or ""
+    save_dir = gain_conf.get(CONF_SAVE_DIR)
+    well_name = WELL_NAME.format(well_x, well_y)
     make_plots = bool(save_dir)
-    plot_dir = Path(save_dir) / "plots"
-    await center.add_executor_job(ensure_plot_dir, plot_dir)
+    plot_path = None
+    if make_plots:
+        # This should be a path to a base file name, not to a dir or file.
+        plot_path = os.path.join(save_dir, PLOTS, well_name)
 
     init_gain = [
         Channel(channel[CONF_CHANNEL], gain=gain)
@@ -116,15 +124,17 @@ async def calc_gain(
         for gain in channel[CONF_INIT_GAIN]
     ]
 
-    # This should be a path to a base file name, not to a dir or file.
-    plot_path = plot_dir / WELL_NAME.format(well_x, well_y)
+    # Fit the projections concurrently in the executor.
+    fits = await asyncio.gather(
+        *(center.add_executor_job(_fit_projection, proj) for proj in projs.values())
+    )
     gains = await center.add_executor_job(
-        partial(_calc_gain, projs, init_gain, plot=make_plots, save_path=plot_path)
+        partial(_calc_gain, dict(zip(projs, fits)), init_gain, save_path=plot_path)
     )
     _LOGGER.info("Calculated gains: %s", gains)
     if SAVED_GAINS not in center.data:
         center.data[SAVED_GAINS] = defaultdict(dict)
-    center.data[SAVED_GAINS].update({WELL_NAME.format(well_x, well_y): gains})
+    center.data[SAVED_GAINS].update({well_name: gains})
     if make_plots:
         await center.add_executor_job(
             save_gain, save_dir, center.data[SAVED_GAINS], [WELL] + list(gains)
@@ -143,129 +153,212 @@ async def calc_gain(
         await center.bus.notify(event)  # await in sequential order
 
 
+def make_proj(images):
+    """Make a dict of max projections from a dict of paths and channel ids.
+
+    Each channel will make one max projection. The projection is kept
+    as a running maximum, updated in place with each channel image.
+    """
+    _LOGGER.info("Making max projections...")
+    proj_data = {}
+    last_images = {}
+    for path, channel in images.items():
+        image = ImageData(path=path)
+        data = image.data
+        if data.shape[0] in SKIP_IMAGE_SIDES:
+            continue
+        proj = proj_data.get(channel)
+        if proj is None:
+            # Copy the first image to not change the image data in place.
+            proj = proj_data[channel] = data.copy()
+        else:
+            np.maximum(proj, data, out=proj)
+        last_images[channel] = image
+    # Wrap each projection once, with the path and metadata of the last image.
+    return {
+        channel: ImageData(
+            path=image.path, data=proj_data[channel], metadata=image.metadata
+        )
+        for channel, image in last_images.items()
+    }
+
+
 def _power_func(inp, alpha, beta):
     """Return the value of function of inp, alpha and beta."""
     return alpha * inp**beta
 
 
-def _check_upward(points):
-    """Return a function that checks if points move upward."""
+def _power_jac(inp, alpha, beta):
+    """Return the jacobian of the power function with respect to alpha and beta."""
+    inp = np.asarray(inp, dtype=np.float64)
+    inp_pow = inp**beta
+    return np.column_stack((inp_pow, alpha * inp_pow * np.log(inp)))
 
-    def wrapped(point):
-        """Return True if trend is upward.
 
-        The calculation is done for a point with neighboring points.
-        """
-        idx, item = point
-        valid = item.valid and item.box <= 600
-        prev = next_ = True
-        if idx > 0:
-            prev = item.box >= points[idx - 1].box
-        if idx < len(points) - 1:
-            next_ = item.box <= points[idx + 1].box
-        return valid and (prev or next_)
+def _fit_power_func(x_data, y_data, p0):
+    """Fit the power function to the data and return the coefficients.
 
-    return wrapped
+    Raise RuntimeError if the fit does not converge.
+    """
+    # The data sets are small and the model is known,
+    # so cap the evaluations and relax the tolerances.
+    # pylint: disable=unbalanced-tuple-unpacking
+    coeffs, _ = curve_fit(
+        _power_func,
+        x_data,
+        y_data,
+        p0=p0,
+        jac=_power_jac,
+        method="lm",
+        maxfev=200,
+        xtol=1e-6,
+        ftol=1e-6,
+    )
+    return coeffs
 
 
-def _create_plot(path, x_data, y_data, coeffs, label):
-    """Plot and save plot to path."""
-    plt.ioff()
-    plt.clf()
-    plt.yscale("log")
-    plt.xscale("log")
-    plt.plot(
+def _check_upward(boxes, valid):
+    """Return a boolean array that is True where points move upward.
+
+    The calculation is done for each point with neighboring points.
+    """
+    prev = np.ones(boxes.size, dtype=bool)
+    next_ = np.ones(boxes.size, dtype=bool)
+    prev[1:] = boxes[1:] >= boxes[:-1]
+    next_[:-1] = boxes[:-1] <= boxes[1:]
+    return valid & (boxes <= 600) & (prev | next_)
+
+
+def _longest_run(keys):
+    """Return start and end index of the longest run of True values in keys."""
+    # Pad with False to find the edges of all runs, also at the ends.
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], keys.view(np.int8), [0]))))
+    if not edges.size:
+        return 0, 0
+    starts, ends = edges[0::2], edges[1::2]
+    idx = np.argmax(ends - starts)
+    return int(starts[idx]), int(ends[idx])
+
+
+def _create_plot(fig, path, x_data, y_data, coeffs, label):
+    """Plot on the reused figure and save plot to path."""
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    x_data = np.asarray(x_data, dtype=np.float64)
+    axes = fig.gca()
+    axes.clear()
+    axes.set_yscale("log")
+    axes.set_xscale("log")
+    axes.plot(
         x_data, y_data, "bo", x_data, _power_func(x_data, *coeffs), "g-", label=label
     )
-    plt.savefig(path)
+    fig.savefig(path)
 
 
-def _calc_gain(projs, init_gain, plot=True, save_path=""):
+def _fit_projection(proj):
+    """Fit a power function to the count-box histogram data of a projection.
+
+    Return a tuple of counts, boxes and fit coefficients,
+    or None if there is not enough data to fit.
+    """
+    # Use float arrays from the start to pass masked data directly to curve_fit.
+    counts = np.asarray(proj.histogram[0], dtype=np.float64)
+    boxes = np.arange(counts.size, dtype=np.float64)
+    # Handle all zero pixels, skipping box 0.
+    non_zero = np.flatnonzero(counts[1:])
+    if not non_zero.size:
+        return None
+    # Find the max box holding pixels
+    box_max_count = non_zero[-1] + 1
+    # Select only histo data where count is > 0 and 255 > box > 0.
+    # Only use values in interval 10-100 and
+    # > (max box holding pixels - 175).
+    roi = (
+        (boxes > 0)
+        & (boxes < 255)
+        & (counts >= 10)
+        & (counts <= 100)
+        & (boxes > (box_max_count - 175))
+    )
+    if np.count_nonzero(roi) < 3:
+        return None
+    try:
+        coeffs = _fit_power_func(counts[roi], boxes[roi], p0=(1000, -1))
+    except RuntimeError as exc:
+        _LOGGER.warning("Failed to fit count-box data: %s", exc)
+        return None
+    return counts, boxes, coeffs
+
+
+def _calc_gain(fits, init_gain, save_path=None):
     """Calculate gain values for the well.
 
-    Do the actual math.
+    Do the actual math, using the count-box fits of the projections.
+    Plots are only made if save_path is set.
     """
     # pylint: disable=too-many-locals
     box_vs_gain = {}
+    plot = save_path is not None
+    fig = None
+    if plot:
+        # Only pay for importing matplotlib when plots are made.
+        # Use the object oriented api to avoid pyplot global state.
+        # pylint: disable=import-outside-toplevel
+        from matplotlib.figure import Figure
 
-    for c_id, proj in projs.items():
+        fig = Figure()
+
+    for c_id, fit in fits.items():
         channel = init_gain[c_id]
         if channel.name not in box_vs_gain:
-            box_vs_gain[channel.name] = []
-        hist_data = pd.DataFrame(
-            {BOX: list(range(len(proj.histogram[0]))), COUNT: proj.histogram[0]}
-        )
-        # Handle all zero pixels
-        non_zero_hist_data = hist_data[(hist_data[COUNT] > 0) & (hist_data[BOX] > 0)]
-        if non_zero_hist_data.empty:
+            box_vs_gain[channel.name] = {BOX: [], GAIN: [], VALID: []}
+        if fit is None:
             continue
-        # Find the max box holding pixels
-        box_max_count = non_zero_hist_data[BOX].iloc[-1]
-        # Select only histo data where count is > 0 and 255 > box > 0.
-        # Only use values in interval 10-100 and
-        # > (max box holding pixels - 175).
-        roi = hist_data[
-            (hist_data[COUNT] > 0)
-            & (hist_data[BOX] > 0)
-            & (hist_data[BOX] < 255)
-            & (hist_data[COUNT] >= 10)
-            & (hist_data[COUNT] <= 100)
-            & (hist_data[BOX] > (box_max_count - 175))
-        ]
-        if roi.shape[0] < 3:
-            continue
-        x_data = roi[COUNT].astype(float).values
-        y_data = roi[BOX].astype(float).values
-        # pylint: disable=unbalanced-tuple-unpacking
-        coeffs, _ = curve_fit(_power_func, x_data, y_data, p0=(1000, -1))
+        counts, boxes, coeffs = fit
         if plot:
             _save_path = f"{save_path}_{CHANNEL_ID.format(c_id)}.ome.png"
-            _create_plot(
-                _save_path, hist_data[COUNT], hist_data[BOX], coeffs, "count-box"
-            )
+            _create_plot(fig, _save_path, counts, boxes, coeffs, "count-box")
         # Find box value where count is close to zero.
         # Store that box value and it's corresponding gain value.
         # Store boolean saying if second slope coefficient is negative.
-        box_vs_gain[channel.name].append(
-            Data._make(
-                (_power_func(COUNT_CLOSE_TO_ZERO, *coeffs), channel.gain, coeffs[1] < 0)
-            )
-        )
+        points = box_vs_gain[channel.name]
+        points[BOX].append(_power_func(COUNT_CLOSE_TO_ZERO, *coeffs))
+        points[GAIN].append(channel.gain)
+        points[VALID].append(coeffs[1] < 0)
 
     gains = {}
     for channel, points in box_vs_gain.items():
         # Sort points with ascending gain, to allow grouping.
-        points = sorted(points, key=lambda item: item.gain)
-        long_group = []
-        for key, group in groupby(enumerate(points), _check_upward(points)):
-            # Find the group with the most points and use that below.
-            stored_group = list(group)
-            if key and len(stored_group) > len(long_group):
-                long_group = stored_group
+        order = np.argsort(points[GAIN], kind="stable")
+        boxes = np.asarray(points[BOX], dtype=np.float64)[order]
+        channel_gains = np.asarray(points[GAIN], dtype=np.float64)[order]
+        valid = np.asarray(points[VALID], dtype=bool)[order]
+        # Find the group with the most points and use that below.
+        start, end = _longest_run(_check_upward(boxes, valid))
 
         # Curve fit the longest group with power function.
         # Plot the points and the fit.
         # Return the calculated gains at bin 255, using fit function.
-        if len(long_group) < 3:
+        if end - start < 3:
+            gains[channel] = None
+            continue
+        try:
+            coeffs = _fit_power_func(
+                boxes[start:end], channel_gains[start:end], p0=(1, 1)
+            )
+        except RuntimeError as exc:
+            _LOGGER.warning("Failed to fit box-gain data for %s: %s", channel, exc)
             gains[channel] = None
             continue
-        coeffs, _ = curve_fit(  # pylint: disable=unbalanced-tuple-unpacking
-            _power_func,
-            [p[1].box for p in long_group],
-            [p[1].gain for p in long_group],
-            p0=(1, 1),
-        )
         if plot:
             _save_path = f"{save_path}_{channel}.png"
-            _create_plot(
-                _save_path,
-                [p.box for p in points],
-                [p.gain for p in points],
-                coeffs,
-                "box-gain",
-            )
+            _create_plot(fig, _save_path, boxes, channel_gains, coeffs, "box-gain")
         gains[channel] = round(_power_func(255, *coeffs))
 
+    if fig is not None:
+        # The figure holds reference cycles, so release the plotted data now
+        # instead of waiting for the garbage collector.
+        fig.clear()
+
     return gains
 
 
@@ -279,8 +372,7 @@ def save_gain(save_dir, saved_gains, header):
 
 def ensure_plot_dir(plot_dir):
     """Make sure that plot dir exists."""
-    if not plot_dir.exists():
-        plot_dir.mkdir()
+    Path(plot_dir).mkdir(exist_ok=True)
 
 
 class GainCalcEvent(Event):
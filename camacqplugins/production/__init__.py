@@ -1,9 +1,11 @@
 """Provide a plugin for production standard flow."""
 
+import asyncio
+import csv
 import logging
+from itertools import product
 from math import ceil
 
-import pandas as pd
 import voluptuous as vol
 
 from camacq.const import CAMACQ_START_EVENT, IMAGE_EVENT
@@ -35,21 +37,46 @@ CONF_X_FIELDS = "x_fields"
 CONF_Y_FIELDS = "y_fields"
 CONF_SAMPLE_STATE_FILE = "sample_state_file"
 
+IMAGE_NAME = "U{:02}--V{:02}--E{:02}--X{:02}--Y{:02}--Z{:02}--C{:02}.ome.tif"
+LOAD_SAMPLE_CHUNK_SIZE = 128
 PLATE_NAME = "00"
 SAMPLE_PLATE_NAME = "plate_name"
 SAMPLE_WELL_X = "well_x"
 SAMPLE_WELL_Y = "well_y"
 
+# Map sample names that are allowed in the sample state file to their schema.
+SAMPLE_STATE_SCHEMAS = {
+    schema.schema["name"]: schema
+    for schema in SET_SAMPLE_SCHEMA.validators
+    if schema.schema["name"] not in ("plate", "image")
+}
+
 
 def read_csv(path):
     """Return a list where each item is a row and dict."""
     try:
-        data = pd.read_csv(path, dtype=str)
-        data = data.fillna(value="")
+        # Use utf-8-sig to also accept files saved with a byte order mark.
+        with open(path, newline="", encoding="utf-8-sig") as csv_file:
+            # Build the rows directly while reading, with empty strings for
+            # missing cells, instead of going through a dataframe.
+            reader = csv.DictReader(csv_file, restval="")
+            if not reader.fieldnames:
+                raise vol.Invalid("Sample state file has no header")
+            rows = list(reader)
+    except vol.Invalid as exc:
+        _LOGGER.error("Failed to read csv file: %s", exc)
+        raise
     except Exception as exc:  # pylint: disable=broad-except
         _LOGGER.error("Failed to read csv file: %s", exc)
-        raise vol.Invalid from exc
-    return data.to_dict(orient="records")
+        raise vol.Invalid(f"Failed to read csv file: {exc}") from exc
+
+    for idx, row in enumerate(rows):
+        # Extra cells without a column name are stored under the None key.
+        if None in row:
+            _LOGGER.error("The csv file has too many cells at row %s", idx + 2)
+            raise vol.Invalid(f"Too many cells in csv file at row {idx + 2}")
+
+    return rows
 
 
 @vol.truth
@@ -61,36 +88,27 @@ def is_csv(value):
 def is_sample_state(value):
     """Validate state data.
 
-    At least one sample action must validate per sample data item.
+    The sample schema matching the name must validate per sample data item.
     """
-    schemas = list(SET_SAMPLE_SCHEMA.validators)
     for idx, data in enumerate(value):
-        valid = False
         error = None
-        sample_name = data.get("name")
-        for schema in schemas:
-            if (
-                schema.schema["name"] in ("plate", "image")
-                or schema.schema["name"] != sample_name
-            ):
-                continue
+        schema = SAMPLE_STATE_SCHEMAS.get(data.get("name"))
+        if schema is not None:
             try:
                 data.update(schema(data))
             except vol.Invalid as exc:
                 error = exc
+            else:
                 continue
-            valid = True
-            break
-
-        if not valid:
-            _LOGGER.error(
-                "The sample state file contains invalid data at row %s: %s",
-                idx + 2,
-                error,
-            )
-            if error:
-                raise error
-            raise vol.Invalid("Invalid sample state file")
+
+        _LOGGER.error(
+            "The sample state file contains invalid data at row %s: %s",
+            idx + 2,
+            error,
+        )
+        if error:
+            raise error
+        raise vol.Invalid("Invalid sample state file")
 
     return value
 
@@ -158,10 +176,31 @@ class WorkFlow:
         self.gain_job_channels = conf[CONF_GAIN_JOB_CHANNELS]
         self.exp_pattern = conf[CONF_EXP_PATTERN_NAME]
         self.exp_job_ids = conf[CONF_EXP_JOB_IDS]
+        # Map job id and channel id of experiment images to new channel id.
+        # Later items override earlier items, so list the first job last.
+        self._rename_channel_ids = {
+            (self.exp_job_ids[2], 0): 3,
+            (self.exp_job_ids[2], 1): 3,
+            (self.exp_job_ids[1], 0): 1,
+            (self.exp_job_ids[1], 1): 2,
+            (self.exp_job_ids[0], 0): 0,
+            (self.exp_job_ids[0], 1): 0,
+        }
         self.channels = conf[CONF_CHANNELS]
+        self._channel_by_name = {
+            channel[CONF_CHANNEL]: (channel_id, channel)
+            for channel_id, channel in enumerate(self.channels)
+        }
         well_layout = conf[CONF_WELL_LAYOUT]
         self.x_fields = well_layout[CONF_X_FIELDS]
         self.y_fields = well_layout[CONF_Y_FIELDS]
+        self._last_gain_coords = get_last_gain_coords(self.x_fields, self.y_fields)
+        # Match a well event for the last field of a well that has been imaged.
+        self._well_done_match = {
+            "field_x": self.x_fields - 1,
+            "field_y": self.y_fields - 1,
+            "well_img_ok": True,
+        }
         self._remove_handle_exp_image = None
         self.wells_left = set()
 
@@ -180,35 +219,35 @@ class WorkFlow:
         for data in state_data:
             well_coord = data[SAMPLE_WELL_X], data[SAMPLE_WELL_Y]
             self.wells_left.add(well_coord)
-            await self._center.actions.sample.set_sample(silent=True, **data)
+
+        set_sample = self._center.actions.sample.set_sample
+        # Set the sample state concurrently in chunks of rows.
+        for start in range(0, len(state_data), LOAD_SAMPLE_CHUNK_SIZE):
+            end = start + LOAD_SAMPLE_CHUNK_SIZE
+            chunk = state_data[start:end]
+            await asyncio.gather(*(set_sample(silent=True, **data) for data in chunk))
 
     def image_next_well_on_sample(self):
         """Image next well in existing sample."""
 
         async def send_cam_job(center, event):
             """Run on well event."""
-            next_well_x, next_well_y = next_well_xy(center.samples.leica, PLATE_NAME)
-
-            if (
-                not match_event(event, event_type=CAMACQ_START_EVENT)
-                and not match_event(
-                    event,
-                    field_x=self.x_fields - 1,
-                    field_y=self.y_fields - 1,
-                    well_img_ok=True,
-                )
-                or next_well_x is None
-                or (next_well_x, next_well_y) not in self.wells_left
-            ):
+            start = match_event(event, event_type=CAMACQ_START_EVENT)
+            if not start and not match_event(event, **self._well_done_match):
+                return
+
+            leica = center.samples.leica
+            next_well_x, next_well_y = next_well_xy(leica, PLATE_NAME)
+            if next_well_x is None or (next_well_x, next_well_y) not in self.wells_left:
                 return
 
-            if center.samples.leica.images:
+            if leica.images:
                 await center.actions.command.stop_imaging()
             await self.send_gain_jobs(
                 next_well_x,
                 next_well_y,
             )
-            self.wells_left.remove((next_well_x, next_well_y))
+            self.wells_left.discard((next_well_x, next_well_y))
 
         removes = []
         removes.append(self._center.bus.register(CAMACQ_START_EVENT, send_cam_job))
@@ -224,26 +263,38 @@ class WorkFlow:
 
     def analyze_gain(self):
         """Analyze gain."""
+        field_x, field_y = self._last_gain_coords
+        gain_image_match = {
+            "field_x": field_x,
+            "field_y": field_y,
+            "job_id": self.gain_job_id,
+            "channel_id": self.gain_job_channels - 1,
+        }
+        # Wells where the gain calculation has been started.
+        gain_wells = set()
 
         async def calc_gain(center, event):
             """Calculate correct gain."""
-            field_x, field_y = get_last_gain_coords(self.x_fields, self.y_fields)
-            channel_id = self.gain_job_channels - 1
-            if not match_event(
-                event,
-                field_x=field_x,
-                field_y=field_y,
-                job_id=self.gain_job_id,
-                channel_id=channel_id,
-            ):
+            if not match_event(event, **gain_image_match):
+                return
+            well_coord = event.plate_name, event.well_x, event.well_y
+            # Skip duplicate gain image events for the same well.
+            # There is no await between the check and the add.
+            if well_coord in gain_wells:
                 return
+            gain_wells.add(well_coord)
 
-            await center.actions.command.stop_imaging()
-            await center.actions.gain.calc_gain(
-                plate_name=event.plate_name,
-                well_x=event.well_x,
-                well_y=event.well_y,
-            )
+            try:
+                await center.actions.command.stop_imaging()
+                await center.actions.gain.calc_gain(
+                    plate_name=event.plate_name,
+                    well_x=event.well_x,
+                    well_y=event.well_y,
+                )
+            except Exception:
+                # Allow a later gain image event to retry the well.
+                gain_wells.discard(well_coord)
+                raise
 
         return self._center.bus.register(IMAGE_EVENT, calc_gain)
 
@@ -252,13 +303,11 @@ class WorkFlow:
 
         async def set_gain(center, event):
             """Set pmt gain."""
-            channel_id, channel = next(
-                (
-                    (channel_id, channel)
-                    for channel_id, channel in enumerate(self.channels)
-                    if event.channel_name == channel[CONF_CHANNEL]
-                )
-            )
+            channel_item = self._channel_by_name.get(event.channel_name)
+            if channel_item is None:
+                _LOGGER.error("Unknown channel name: %s", event.channel_name)
+                return
+            channel_id, channel = channel_item
             exp = channel[CONF_JOB_NAME]
             num = channel[CONF_DETECTOR_NUM]
             gain = min(event.gain or channel[CONF_DEFAULT_GAIN], channel[CONF_MAX_GAIN])
@@ -281,10 +330,13 @@ class WorkFlow:
 
     def add_exp_job(self):
         """Add experiment job."""
+        last_channel_name = self.channels[-1][CONF_CHANNEL]
+        field_grid = tuple(product(range(self.x_fields), range(self.y_fields)))
 
         async def add_cam_job(center, event):
             """Add an experiment job to the cam list."""
-            last_channel = self.channels[-1]
+            if not match_event(event, channel_name=last_channel_name):
+                return
             channels = get_matched_samples(
                 center.samples.leica,
                 "channel",
@@ -294,33 +346,25 @@ class WorkFlow:
                     "well_y": event.well_y,
                 },
             )
-            if not match_event(event, channel_name=last_channel[CONF_CHANNEL]) or len(
-                channels
-            ) != len(self.channels):
+            if len(channels) != len(self.channels):
                 return
 
-            commands = []
-            for field_x in range(self.x_fields):
-                for field_y in range(self.y_fields):
-                    cmd = cam_com(
-                        self.exp_pattern,
-                        event.well_x,
-                        event.well_y,
-                        field_x,
-                        field_y,
-                        0,
-                        0,
-                    )
-                    commands.append(cmd)
-
-            await center.actions.command.send(command=del_com())
-            await center.actions.command.send_many(commands=commands)
+            # Clear the cam list before adding the experiment jobs.
+            commands = [del_com()] + [
+                cam_com(
+                    self.exp_pattern, event.well_x, event.well_y, field_x, field_y, 0, 0
+                )
+                for field_x, field_y in field_grid
+            ]
+
+            command = center.actions.command
+            await command.send_many(commands=commands)
 
             if self._remove_handle_exp_image is None:
                 self._remove_handle_exp_image = self.handle_exp_image()
 
-            await center.actions.command.start_imaging()
-            await center.actions.command.send(command="/cmd:startcamscan")
+            await command.start_imaging()
+            await command.send(command="/cmd:startcamscan")
 
         return self._center.bus.register(CHANNEL_EVENT, add_cam_job)
 
@@ -339,12 +383,7 @@ class WorkFlow:
 
         async def stop_imaging(center, event):
             """Run to stop the experiment."""
-            match = match_event(
-                event,
-                field_x=self.x_fields - 1,
-                field_y=self.y_fields - 1,
-                well_img_ok=True,
-            )
+            match = match_event(event, **self._well_done_match)
 
             if not match or self.wells_left:
                 return
@@ -357,42 +396,39 @@ class WorkFlow:
 
     async def send_gain_jobs(self, well_x, well_y):
         """Send gain cam jobs for the center fields of a well."""
-        field_x, field_y = get_last_gain_coords(self.x_fields, self.y_fields)
+        field_x, field_y = self._last_gain_coords
         field_x = field_x - 1  # set the start x field coord
 
-        await self._center.actions.command.send(command=del_com())
+        # Clear the cam list before adding the gain jobs.
+        commands = [del_com()] + [
+            cam_com(self.gain_pattern, well_x, well_y, field_x, field_y, 0, 0)
+            for field_x in range(field_x, field_x + 2)
+        ]
 
-        for field_x in range(field_x, field_x + 2):
-            command = cam_com(self.gain_pattern, well_x, well_y, field_x, field_y, 0, 0)
-            await self._center.actions.command.send(command=command)
+        command = self._center.actions.command
+        await command.send_many(commands=commands)
 
         if self._remove_handle_exp_image is not None:
             self._remove_handle_exp_image()
             self._remove_handle_exp_image = None
 
-        await self._center.actions.command.start_imaging()
-        await self._center.actions.command.send(command="/cmd:startcamscan")
+        await command.start_imaging()
+        await command.send(command="/cmd:startcamscan")
 
     async def rename_image(self, center, event):
         """Rename an image."""
-        if event.job_id not in self.exp_job_ids or event.channel_id not in (0, 1):
-            return
-
-        if event.job_id == self.exp_job_ids[0]:
-            channel_id = 0
-        elif event.job_id == self.exp_job_ids[1] and event.channel_id == 0:
-            channel_id = 1
-        elif event.job_id == self.exp_job_ids[1] and event.channel_id == 1:
-            channel_id = 2
-        elif event.job_id == self.exp_job_ids[2]:
-            channel_id = 3
-        else:
+        channel_id = self._rename_channel_ids.get((event.job_id, event.channel_id))
+        if channel_id is None:
             return
 
-        new_name = (
-            f"U{event.well_x:02}--V{event.well_y:02}--E{event.job_id:02}--"
-            f"X{event.field_x:02}--Y{event.field_y:02}--"
-            f"Z{event.z_slice:02}--C{channel_id:02}.ome.tif"
+        new_name = IMAGE_NAME.format(
+            event.well_x,
+            event.well_y,
+            event.job_id,
+            event.field_x,
+            event.field_y,
+            event.z_slice,
+            channel_id,
         )
 
         await center.actions.rename_image.rename_image(
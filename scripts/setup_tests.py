@@ -1,99 +1,105 @@
 #!/usr/bin/env python3
 """Tool to generate image fixture for tests from real image data."""
 import argparse
-import fnmatch
-import gzip
 import os
-import shutil
+import sys
+import zipfile
+from itertools import chain
 from pathlib import Path
 
 import numpy as np
 import tifffile
 
 IMAGE_DATA_DIR = os.path.join(os.path.dirname(__file__), "../tests/fixtures/image_data")
+IMAGE_FIXTURE = os.path.join(IMAGE_DATA_DIR, "image_data.npz")
 
 
 def _find_files(root_dir, search):
     """Search for files in root directory."""
-    matches = []
-    for root, _, filenames in os.walk(os.path.normpath(root_dir)):
-        for filename in fnmatch.filter(filenames, search):
-            matches.append(os.path.join(root, filename))
-    return matches
+    return [
+        str(path)
+        for path in Path(os.path.normpath(root_dir)).rglob(search)
+        if path.is_file()
+    ]
 
 
-def pack_image_fixture(root_dir=None):
-    """Gunzip tif images for image tests."""
+def find_images(root_dir=None):
+    """Return a list of paths to tif images in root directory."""
     if root_dir is None:
         root_dir = IMAGE_DATA_DIR
-    matches = _find_files(root_dir, "*.tif")
-    print("Gzipping the images, this will take some time...")
-    for path in matches:
-        gz_path = f"{path}.gz"
-        with open(path, "rb") as f_in:
-            with gzip.open(gz_path, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        os.remove(path)
-
-
-def unpack_image_fixture(root_dir=None):
-    """Unzip gunzipped tif images for image tests."""
-    if root_dir is None:
-        root_dir = IMAGE_DATA_DIR
-    matches = _find_files(root_dir, "*.gz")
-    for gz_path in matches:
-        path, _ = os.path.splitext(gz_path)
-        with gzip.open(gz_path, "rb") as f_in:
-            with open(path, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
+    return _find_files(root_dir, "*.tif")
 
 
-def read_image_data(root_dir=None):
-    """Return a list of dicts with path and image numpy array data."""
-    if root_dir is None:
-        root_dir = IMAGE_DATA_DIR
-    matches = _find_files(root_dir, "*.tif")
-    image_data = []
-    for path in matches:
+def iter_image_data(paths):
+    """Yield dicts with path and image numpy array data, one image at a time."""
+    for path in paths:
         try:
             data = tifffile.imread(path, key=0)
         except OSError as exc:
             print("Failed reading image:", exc)
             raise
 
-        image_data.append({"path": path, "data": data})
+        yield {"path": path, "data": data}
 
-    return image_data
 
+def save_images_to_npz(path, image_paths):
+    """Save image data as compressed npz, streaming one image at a time.
 
-def save_images_to_npz(path):
-    """Save image data as compressed npz."""
+    The archive is written to a temporary file, which replaces path only
+    when all images have been saved.
+    """
+    if not image_paths:
+        raise ValueError("No images to save")
     path = Path(path).resolve()
-    image_data = read_image_data()
-    np.savez_compressed(path, **{data["path"]: data["data"] for data in image_data})
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    images = iter_image_data(image_paths)
+    # Read the first image before creating the archive.
+    first_image = next(images)
+    try:
+        with zipfile.ZipFile(
+            tmp_path, mode="w", compression=zipfile.ZIP_DEFLATED
+        ) as archive:
+            for image in chain([first_image], images):
+                with archive.open(
+                    f"{image['path']}.npy", mode="w", force_zip64=True
+                ) as fil:
+                    np.lib.format.write_array(fil, image["data"], allow_pickle=False)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
 
 
 def get_arguments(args=None):
     """Get parsed arguments."""
-    parser = argparse.ArgumentParser(description="Unpack or pack fixture files.")
-    parser.add_argument("--pack", action="store_true", help="Pack fixture files.")
-    parser.add_argument("--npz", help="Save image fixture data in a npz file.")
+    parser = argparse.ArgumentParser(
+        description="Save tif images as the npz image fixture for tests."
+    )
+    parser.add_argument(
+        "--npz", default=IMAGE_FIXTURE, help="Save image fixture data in a npz file."
+    )
+    parser.add_argument(
+        "--root-dir", default=IMAGE_DATA_DIR, help="Directory to search for tifs."
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Overwrite an existing npz file."
+    )
     args = parser.parse_args(args=args)
 
     return args
 
 
 def main(args=None):
-    """Pack or unpack the images for test fixtures."""
+    """Generate the npz image fixture from tif images if it is missing."""
     args = get_arguments(args=args)
 
-    if args.npz:
-        save_images_to_npz(args.npz)
+    if os.path.exists(args.npz) and not args.force:
+        print("Image fixture already exists:", args.npz)
         return
-    if args.pack:
-        pack_image_fixture()
-    else:
-        unpack_image_fixture()
+    image_paths = find_images(args.root_dir)
+    if not image_paths:
+        sys.exit(f"No tif images found in: {args.root_dir}")
+    save_images_to_npz(args.npz, image_paths)
 
 
 if __name__ == "__main__":
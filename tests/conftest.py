@@ -1,10 +1,13 @@
 """Provide package level pytest fixtures."""
 
+import numpy as np
 import pytest
 
 from camacq.control import Center
 from camacq.plugins.leica import sample as leica_sample_mod
 
+from tests.common import IMAGE_DATA_DIR
+
 
 @pytest.fixture(name="center")
 def center_fixture(event_loop):
@@ -18,3 +21,10 @@ def center_fixture(event_loop):
 async def leica_sample_fixture(center):
     """Mock leica sample."""
     await leica_sample_mod.setup_module(center, {})
+
+
+@pytest.fixture(name="image_data", scope="session")
+def image_data_fixture():
+    """Load the image fixture data once per test session."""
+    with np.load(IMAGE_DATA_DIR / "image_data.npz") as image_data:
+        return {path: image_data[path] for path in image_data.files}
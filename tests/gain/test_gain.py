@@ -1,17 +1,52 @@
 """Test gain calculation."""
 
+import asyncio
+from copy import deepcopy
 from unittest.mock import patch, PropertyMock
 
-import numpy as np
 import pytest
 
 from camacq import plugins
 from camacq.plugins.leica import LeicaImageEvent
 from camacqplugins.gain import GAIN_CALC_EVENT
-from tests.common import IMAGE_DATA_DIR
+from tests.common import WELL_NAME
 
 PLATE_NAME = "slide"
 WELL_X, WELL_Y = 1, 0
+CONFIG = {
+    "gain": {
+        "channels": [
+            {
+                "channel": "green",
+                "init_gain": [
+                    450,
+                    495,
+                    540,
+                    585,
+                    630,
+                    675,
+                    720,
+                    765,
+                    810,
+                    855,
+                    900,
+                ],
+            },
+            {
+                "channel": "blue",
+                "init_gain": [400, 435, 470, 505, 540, 575, 610],
+            },
+            {
+                "channel": "yellow",
+                "init_gain": [550, 585, 620, 655, 690, 725, 760],
+            },
+            {
+                "channel": "red",
+                "init_gain": [525, 560, 595, 630, 665, 700, 735],
+            },
+        ],
+    }
+}
 
 
 @pytest.fixture(name="load_image")
@@ -26,45 +61,8 @@ def load_image_fixture():
         yield load_image
 
 
-async def test_gain(center, leica_sample, load_image):
-    """Run gain calculation test."""
-    config = {
-        "gain": {
-            "channels": [
-                {
-                    "channel": "green",
-                    "init_gain": [
-                        450,
-                        495,
-                        540,
-                        585,
-                        630,
-                        675,
-                        720,
-                        765,
-                        810,
-                        855,
-                        900,
-                    ],
-                },
-                {
-                    "channel": "blue",
-                    "init_gain": [400, 435, 470, 505, 540, 575, 610],
-                },
-                {
-                    "channel": "yellow",
-                    "init_gain": [550, 585, 620, 655, 690, 725, 760],
-                },
-                {
-                    "channel": "red",
-                    "init_gain": [525, 560, 595, 630, 665, 700, 735],
-                },
-            ],
-        }
-    }
-    await plugins.setup_module(center, config)
-    image_fixture = IMAGE_DATA_DIR / "image_data.npz"
-    image_data = await center.add_executor_job(np.load, image_fixture)
+async def calc_well_gain(center, load_image, image_data):
+    """Calculate gain for the well and return the gains."""
 
     def mock_load_image(image):
         """Mock load image."""
@@ -73,10 +71,10 @@ async def test_gain(center, leica_sample, load_image):
 
     load_image.side_effect = mock_load_image
 
-    events = [LeicaImageEvent({"path": path}) for path in image_data]
-
-    for event in events:
-        await center.bus.notify(event)
+    # The image events only add images to the sample, so notify concurrently.
+    await asyncio.gather(
+        *(center.bus.notify(LeicaImageEvent({"path": path})) for path in image_data)
+    )
 
     calculated = {}
 
@@ -92,10 +90,49 @@ async def test_gain(center, leica_sample, load_image):
 
     center.bus.register(GAIN_CALC_EVENT, handle_gain_event)
 
-    images = [event.path for event in events]
     await center.actions.gain.calc_gain(
-        plate_name=PLATE_NAME, well_x=WELL_X, well_y=WELL_Y, images=images
+        plate_name=PLATE_NAME, well_x=WELL_X, well_y=WELL_Y, images=list(image_data)
     )
 
+    return calculated
+
+
+async def test_gain(center, leica_sample, load_image, image_data):
+    """Run gain calculation test."""
+    await plugins.setup_module(center, CONFIG)
+    calculated = await calc_well_gain(center, load_image, image_data)
+
+    solution = {"blue": 480, "green": 740, "red": 745, "yellow": 805}
+    assert calculated == pytest.approx(solution, abs=10)
+
+
+async def test_gain_fit_fails(center, leica_sample, load_image, image_data):
+    """Test that gain is None for all channels when no fit converges."""
+    await plugins.setup_module(center, CONFIG)
+    with patch(
+        "camacqplugins.gain.curve_fit",
+        side_effect=RuntimeError("Optimal parameters not found"),
+    ):
+        calculated = await calc_well_gain(center, load_image, image_data)
+
+    assert calculated == {"blue": None, "green": None, "red": None, "yellow": None}
+
+
+async def test_gain_save_dir(center, leica_sample, load_image, image_data, tmp_path):
+    """Test that plots and gains are saved in the save dir."""
+    config = deepcopy(CONFIG)
+    config["gain"]["save_dir"] = str(tmp_path)
+    plot_dir = tmp_path / "plots"
+    await plugins.setup_module(center, config)
+
+    assert plot_dir.is_dir()
+
+    calculated = await calc_well_gain(center, load_image, image_data)
+
     solution = {"blue": 480, "green": 740, "red": 745, "yellow": 805}
     assert calculated == pytest.approx(solution, abs=10)
+    # One count-box plot per fitted image channel.
+    assert len(list(plot_dir.glob(f"{WELL_NAME}_C??.ome.png"))) == 25
+    for channel in solution:
+        assert (plot_dir / f"{WELL_NAME}_{channel}.png").is_file()
+    assert (tmp_path / "output_gains.csv").is_file()
@@ -1,7 +1,9 @@
 """Test the production plugin."""
 
+from copy import deepcopy
 from unittest.mock import AsyncMock, call
 
+import pytest
 import voluptuous as vol
 from ruamel.yaml import YAML
 
@@ -9,6 +11,7 @@ from camacq import plugins
 from camacq.plugins.api import ImageEvent
 from camacq.plugins.sample import get_matched_samples
 from camacqplugins.gain import GainCalcEvent
+from camacqplugins.production import read_csv
 
 CONFIG = """
 production:
@@ -55,6 +58,9 @@ well,00,1,0
 well,00,1,1
 """.strip()
 
+# Parse the config once and give each test a copy.
+PARSED_CONFIG = YAML(typ="safe").load(CONFIG)
+
 
 class WorkflowImageEvent(ImageEvent):
     """Represent a test image event."""
@@ -67,14 +73,45 @@ class WorkflowImageEvent(ImageEvent):
         return self.data.get("job_id")
 
 
-async def test_image_events(center, leica_sample):
+@pytest.fixture(name="config")
+def config_fixture():
+    """Return a copy of the parsed production config."""
+    return deepcopy(PARSED_CONFIG)
+
+
+@pytest.fixture(name="calc_gain")
+def calc_gain_fixture(center):
+    """Register and return a mock calc_gain action."""
+    calc_gain = AsyncMock()
+    center.actions.register(
+        "gain", "calc_gain", calc_gain, vol.Schema({}, extra=vol.ALLOW_EXTRA)
+    )
+    return calc_gain
+
+
+def gain_image_event(plate_name="00", well_x=0, well_y=0):
+    """Return an event for the last gain image of a well."""
+    return WorkflowImageEvent(
+        {
+            "path": "test_path",
+            "plate_name": plate_name,
+            "well_x": well_x,
+            "well_y": well_y,
+            "field_x": 1,
+            "field_y": 1,
+            "job_id": 3,
+            "z_slice_id": 0,
+            "channel_id": 31,
+        }
+    )
+
+
+async def test_image_events(center, leica_sample, config, calc_gain):
     """Test image events."""
-    config = YAML(typ="safe").load(CONFIG)
     plate_name = "00"
     well_x = 0
     well_y = 0
     await plugins.setup_module(center, config)
-    calc_gain = AsyncMock()
     gains = {
         "green": 800,
         "blue": 700,
@@ -102,23 +139,7 @@ async def test_image_events(center, leica_sample):
 
     calc_gain.side_effect = fire_gain_event
 
-    center.actions.register(
-        "gain", "calc_gain", calc_gain, vol.Schema({}, extra=vol.ALLOW_EXTRA)
-    )
-
-    event = WorkflowImageEvent(
-        {
-            "path": "test_path",
-            "plate_name": plate_name,
-            "well_x": well_x,
-            "well_y": well_y,
-            "field_x": 1,
-            "field_y": 1,
-            "job_id": 3,
-            "z_slice_id": 0,
-            "channel_id": 31,
-        }
-    )
+    event = gain_image_event(plate_name, well_x, well_y)
     center.create_task(center.bus.notify(event))
     await center.wait_for()
 
@@ -146,11 +167,61 @@ async def test_image_events(center, leica_sample):
         assert channel.values["gain"] == gain
 
 
-async def test_load_sample(center, leica_sample, tmp_path):
+async def test_duplicate_image_events(center, leica_sample, config, calc_gain):
+    """Test that duplicate gain image events only calculate gain once."""
+    await plugins.setup_module(center, config)
+    event = gain_image_event()
+    center.create_task(center.bus.notify(event))
+    center.create_task(center.bus.notify(event))
+    await center.wait_for()
+
+    assert calc_gain.call_count == 1
+
+
+async def test_retry_failed_gain(center, leica_sample, config, calc_gain):
+    """Test that a gain image event retries a well where gain failed."""
+    await plugins.setup_module(center, config)
+    calc_gain.side_effect = [RuntimeError("Gain failed"), None]
+
+    event = gain_image_event()
+    center.create_task(center.bus.notify(event))
+    await center.wait_for()
+
+    assert calc_gain.call_count == 1
+
+    center.create_task(center.bus.notify(event))
+    await center.wait_for()
+
+    assert calc_gain.call_count == 2
+
+
+async def test_unknown_gain_channel(center, leica_sample, config, caplog):
+    """Test that a gain event for an unknown channel is skipped."""
+    await plugins.setup_module(center, config)
+    event = GainCalcEvent(
+        {
+            "plate_name": "00",
+            "well_x": 0,
+            "well_y": 0,
+            "channel_name": "purple",
+            "gain": 800,
+        }
+    )
+    await center.bus.notify(event)
+
+    assert "Unknown channel name: purple" in caplog.text
+    channels = get_matched_samples(
+        center.samples.leica,
+        "channel",
+        {"plate_name": "00", "well_x": 0, "well_y": 0},
+    )
+    assert not channels
+
+
+async def test_load_sample(center, leica_sample, config, tmp_path):
     """Test loading sample state from file."""
     state_file = tmp_path / "state_file.csv"
     state_file.write_text(SAMPLE_STATE)
-    config = YAML(typ="safe").load(CONFIG)
     config["production"]["sample_state_file"] = str(state_file)
     plate_name = "00"
     await plugins.setup_module(center, config)
@@ -166,3 +237,43 @@ async def test_load_sample(center, leica_sample, tmp_path):
         {"plate_name": plate_name, "well_x": 0, "well_y": 0},
     )
     assert len(fields) == 2
+
+
+async def test_load_sample_byte_order_mark(center, leica_sample, config, tmp_path):
+    """Test loading sample state from file with a byte order mark."""
+    state_file = tmp_path / "state_file.csv"
+    state_file.write_text(SAMPLE_STATE, encoding="utf-8-sig")
+    config["production"]["sample_state_file"] = str(state_file)
+    await plugins.setup_module(center, config)
+    await center.wait_for()
+
+    wells = get_matched_samples(center.samples.leica, "well", {"plate_name": "00"})
+    assert len(wells) == 4
+
+
+def test_read_csv_too_many_cells(tmp_path):
+    """Test that a sample state file row with too many cells is invalid."""
+    state_file = tmp_path / "state_file.csv"
+    state_file.write_text(f"{SAMPLE_STATE}\nwell,00,2,1,,,")
+
+    with pytest.raises(vol.Invalid):
+        read_csv(state_file)
+
+
+@pytest.mark.parametrize("content", ["", "\n"])
+def test_read_csv_empty_file(tmp_path, content):
+    """Test that an empty sample state file is invalid."""
+    state_file = tmp_path / "state_file.csv"
+    state_file.write_text(content)
+
+    with pytest.raises(vol.Invalid, match="no header"):
+        read_csv(state_file)
+
+
+def test_read_csv_decode_error(tmp_path):
+    """Test that a sample state file that can not be decoded is invalid."""
+    state_file = tmp_path / "state_file.csv"
+    state_file.write_bytes(b"name,plate_name\n\xff\xfe,00\n")
+
+    with pytest.raises(vol.Invalid, match="Failed to read csv file"):
+        read_csv(state_file)